@@ -2,6 +2,8 @@
 
 from __future__ import annotations
 
+import struct
+
 from dissect.cstruct import cstruct
 
 ffs_def = """
@@ -463,3 +465,13 @@ struct direct {
 """
 
 c_ffs = cstruct().load(ffs_def)
+
+# Frequently used types, bound to module level names to avoid the cstruct attribute lookup
+ufs1_dinode = c_ffs.ufs1_dinode
+ufs2_dinode = c_ffs.ufs2_dinode
+ufs1_daddr_t = c_ffs.ufs1_daddr_t
+ufs2_daddr_t = c_ffs.ufs2_daddr_t
+
+# Precompiled parser for the fixed size header of struct direct (d_ino, d_reclen, d_type, d_namlen)
+# Directory entries are parsed in a tight loop, so avoid the cstruct overhead for these
+direct_header = struct.Struct("<IHBB")
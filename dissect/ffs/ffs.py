@@ -6,11 +6,19 @@ import os
 import stat
 from functools import cached_property, lru_cache
 from typing import TYPE_CHECKING, BinaryIO
+from weakref import WeakValueDictionary
 
 from dissect.util import ts
 from dissect.util.stream import RunlistStream
 
-from dissect.ffs.c_ffs import c_ffs
+from dissect.ffs.c_ffs import (
+    c_ffs,
+    direct_header,
+    ufs1_daddr_t,
+    ufs1_dinode,
+    ufs2_daddr_t,
+    ufs2_dinode,
+)
 from dissect.ffs.exceptions import (
     Error,
     FileNotFoundError,
@@ -22,6 +30,8 @@ if TYPE_CHECKING:
     from collections.abc import Iterator
     from datetime import datetime
 
+    from dissect.cstruct.types import Array
+
 log = logging.getLogger(__name__)
 log.setLevel(os.getenv("DISSECT_LOG_FFS", "CRITICAL"))
 
@@ -32,6 +42,7 @@ SBLOCKSEARCH = [
     c_ffs.SBLOCK_FLOPPY,
     c_ffs.SBLOCK_PIGGY,
 ]
+FS_MAGIC_OFFSET = c_ffs.fs.fields["fs_magic"].offset
 
 
 class FFS:
@@ -49,41 +60,66 @@ class FFS:
 
         if self.sb.fs_magic == c_ffs.FS_UFS1_MAGIC:
             self.version = 1
-            self._inode_type = c_ffs.ufs1_dinode
-            self._addr_type = c_ffs.ufs1_daddr_t
+            self._inode_type = ufs1_dinode
+            self._addr_type = ufs1_daddr_t
         else:
             self.version = 2
-            self._inode_type = c_ffs.ufs2_dinode
-            self._addr_type = c_ffs.ufs2_daddr_t
+            self._inode_type = ufs2_dinode
+            self._addr_type = ufs2_daddr_t
 
         self.block_size = self.sb.fs_bsize
         self.fragment_size = self.sb.fs_fsize
         self.inode_size = self.sb.fs_bsize // self.sb.fs_inopb
 
-        self.mount_name = bytes(self.sb.fs_fsmnt).split(b"\x00")[0].decode(errors="surrogateescape")
-        self.volume_name = bytes(self.sb.fs_volname).split(b"\x00")[0].decode(errors="surrogateescape")
+        # Snapshot superblock values used in block address arithmetic as plain integers
+        self._frag = int(self.sb.fs_frag)
+        self._nindir = int(self.sb.fs_nindir)
+        self._ipg = int(self.sb.fs_ipg)
+        self._inopb = int(self.sb.fs_inopb)
+        self._fpg = int(self.sb.fs_fpg)
+        self._iblkno = int(self.sb.fs_iblkno)
+        self._old_cgoffset = int(self.sb.fs_old_cgoffset)
+        self._old_cgmask = int(self.sb.fs_old_cgmask)
+        self._fsbtodb = int(self.sb.fs_fsbtodb)
+        self._fragshift = int(self.sb.fs_fragshift)
+
+        self.mount_name = bytes(self.sb.fs_fsmnt).partition(b"\x00")[0].decode(errors="surrogateescape")
+        self.volume_name = bytes(self.sb.fs_volname).partition(b"\x00")[0].decode(errors="surrogateescape")
 
         self.cylinder_group = lru_cache(1024)(self.cylinder_group)
-        self.inode = lru_cache(4096)(self.inode)
+        self._addr_array_type = lru_cache(64)(self._addr_array_type)
+
+        # Deduplicate INode objects that are still referenced, without keeping unreferenced ones alive
+        self._inode_cache = WeakValueDictionary()
+
+        # Symlink inodes that are currently being resolved, to detect links that resolve through themselves
+        self._resolving = set()
 
         self.root = self.inode(c_ffs.UFS_ROOTINO, "/")
 
     @staticmethod
     def read_sb(fh: BinaryIO, offset: int) -> c_ffs.fs:
         fh.seek(offset)
-        try:
-            sb = c_ffs.fs(fh)
-        except Exception:
+        buf = fh.read(len(c_ffs.fs))
+        if len(buf) != len(c_ffs.fs):
             return None
 
-        if sb.fs_magic not in (c_ffs.FS_UFS1_MAGIC, c_ffs.FS_UFS2_MAGIC):
+        # Check the magic before parsing the entire superblock structure
+        magic = c_ffs.int32(buf[FS_MAGIC_OFFSET : FS_MAGIC_OFFSET + 4])
+        if magic not in (c_ffs.FS_UFS1_MAGIC, c_ffs.FS_UFS2_MAGIC):
             return None
 
+        sb = c_ffs.fs(buf)
+
         if sb.fs_ncg < 1 or not (c_ffs.MINBSIZE <= sb.fs_bsize <= c_ffs.MAXBSIZE) or sb.fs_sbsize > c_ffs.SBLOCKSIZE:
             return None
 
         return sb
 
+    def _addr_array_type(self, count: int) -> type[Array]:
+        # Creating an array type in cstruct builds a new class, so these are cached
+        return self._addr_type[count]
+
     def cylinder_group(self, num: int) -> CylinderGroup:
         return CylinderGroup(self, num)
 
@@ -94,7 +130,13 @@ class FFS:
     def inode(
         self, inum: int, name: str | None = None, filetype: int | None = None, parent: INode | None = None
     ) -> INode:
-        return INode(self, inum, name, filetype, parent=parent)
+        # The name, type and parent are part of the key, since an inode can be reachable by different paths
+        # (e.g. hard links, or the . and .. directory entries)
+        key = (inum, name, filetype, parent)
+        if (node := self._inode_cache.get(key)) is None:
+            node = INode(self, inum, name, filetype, parent=parent)
+            self._inode_cache[key] = node
+        return node
 
     def get(self, path: str | int, node: INode | None = None) -> INode:
         if isinstance(path, int):
@@ -108,31 +150,54 @@ class FFS:
             if not part:
                 continue
 
+            # Keep track of the symlinks followed for this component to detect symlink loops
+            # Symlinks still being resolved by an outer lookup also indicate a loop, e.g. a link to "link/x"
+            seen = set()
             while node._type == stat.S_IFLNK and part_num < len(parts):
-                node = node.link_inode
-
-            for entry in node.iterdir():
-                if entry.name == part:
-                    node = entry
-                    break
+                if node.inum in seen or node.inum in self._resolving:
+                    raise Error(f"Symlink loop while resolving: {path}")
+                seen.add(node.inum)
+
+                link = node
+                self._resolving.add(link.inum)
+                try:
+                    node = link.link_inode
+                finally:
+                    self._resolving.discard(link.inum)
+
+            # Reuse the directory listing if it was already built, but don't build (and retain) it just for a lookup
+            if node._dirlist:
+                entry = node._dirlist.get(part)
             else:
+                entry = next((entry for entry in node.iterdir() if entry.name == part), None)
+
+            if entry is None:
                 raise FileNotFoundError(f"File not found: {path}")
+            node = entry
 
         return node
 
     def iter_inodes(self) -> Iterator[INode]:
-        cur_cg = None
-        cur_cgnum = None
+        # Inodes are parsed from whole inode blocks, rather than with a seek and read per inode
+        buf = None
+        buf_block = None
 
-        num_inodes = self.sb.fs_ncg * self.sb.fs_ipg  # number of groups * inodes per group
-        for inum in range(c_ffs.UFS_ROOTINO, num_inodes):
-            cgnum = ino_to_cg(self, inum)
-            if cgnum != cur_cgnum:
-                cur_cg = self.cylinder_group(cgnum)
-                cur_cgnum = cgnum
+        for cg in self.cylinder_groups():
+            for inum in cg.iter_allocated_inodes():
+                if inum < c_ffs.UFS_ROOTINO:
+                    continue
 
-            if cur_cg.inode_allocated(inum):
-                yield self.inode(inum)
+                block = ino_to_fsba(self, inum)
+                if block != buf_block:
+                    self.fh.seek(fsbtodb(self, block) * DEV_BSIZE)
+                    buf = self.fh.read(self.block_size)
+                    buf_block = block
+
+                offset = ino_to_fsbo(self, inum) * self.inode_size
+
+                node = self.inode(inum)
+                node.inode = self._inode_type(buf[offset : offset + self.inode_size])
+                yield node
 
 
 class CylinderGroup:
@@ -148,16 +213,28 @@ class CylinderGroup:
         if self.cg.cg_magic != c_ffs.CG_MAGIC:
             raise Error("Invalid cylinder group magic")
 
+    @cached_property
+    def inode_bitmap(self) -> bytes:
+        self.fs.fh.seek(self.offset + self.cg.cg_iusedoff)
+        return self.fs.fh.read((self.fs._ipg + 7) // 8)
+
     def inode_allocated(self, inum: int) -> bool:
-        rel_inum = inum % self.fs.sb.fs_ipg
+        rel_inum = inum % self.fs._ipg
 
         byte_offset, bit_offset = divmod(rel_inum, 8)
-        offset = self.offset + self.cg.cg_iusedoff + byte_offset
+        return self.inode_bitmap[byte_offset] & (1 << bit_offset) != 0
 
-        self.fs.fh.seek(offset)
-        bitmap = self.fs.fh.read(1)[0]
-
-        return bitmap & (1 << bit_offset) != 0
+    def iter_allocated_inodes(self) -> Iterator[int]:
+        # Walk the bitmap 64 bits at a time, skipping words without any allocated inodes
+        # Within a word, jump between allocated inodes by isolating and clearing the lowest set bit
+        base_inum = self.num * self.fs._ipg
+        bitmap = self.inode_bitmap
+        for offset in range(0, len(bitmap), 8):
+            word = int.from_bytes(bitmap[offset : offset + 8], "little")
+            while word:
+                lowest = word & -word
+                yield base_inum + (offset * 8) + lowest.bit_length() - 1
+                word ^= lowest
 
 
 class INode:
@@ -176,7 +253,7 @@ class INode:
     def __repr__(self) -> str:
         return f"<inode {self.inum:d}>"
 
-    def _read_inode(self) -> c_ffs.ufs1_dinode | c_ffs.ufs2_dinode:
+    def _read_inode(self) -> ufs1_dinode | ufs2_dinode:
         block = fsbtodb(self.fs, ino_to_fsba(self.fs, self.inum))
         offset = (block * DEV_BSIZE) + (ino_to_fsbo(self.fs, self.inum) * self.fs.inode_size)
         self.fs.fh.seek(offset)
@@ -187,7 +264,7 @@ class INode:
         return self.fs.cylinder_group(ino_to_cg(self.fs, self.inum))
 
     @cached_property
-    def inode(self) -> c_ffs.ufs1_dinode | c_ffs.ufs2_dinode:
+    def inode(self) -> ufs1_dinode | ufs2_dinode:
         return self._read_inode()
 
     @cached_property
@@ -203,40 +280,52 @@ class INode:
         return self.inode.di_mode
 
     @cached_property
+    def _timestamps_ns(self) -> tuple[int, int, int, int | None]:
+        # Extract all timestamps from the on-disk inode in one go
+        inode = self.inode
+        atime_ns = (inode.di_atime * 1_000_000_000) + inode.di_atimensec
+        mtime_ns = (inode.di_mtime * 1_000_000_000) + inode.di_mtimensec
+        ctime_ns = (inode.di_ctime * 1_000_000_000) + inode.di_ctimensec
+
+        btime_ns = None
+        if hasattr(inode, "di_birthtime"):
+            btime_ns = (inode.di_birthtime * 1_000_000_000) + inode.di_birthnsec
+
+        return atime_ns, mtime_ns, ctime_ns, btime_ns
+
+    @property
     def atime(self) -> datetime:
         return ts.from_unix_ns(self.atime_ns)
 
-    @cached_property
+    @property
     def atime_ns(self) -> int:
-        return (self.inode.di_atime * 1_000_000_000) + self.inode.di_atimensec
+        return self._timestamps_ns[0]
 
-    @cached_property
+    @property
     def mtime(self) -> datetime:
         return ts.from_unix_ns(self.mtime_ns)
 
-    @cached_property
+    @property
     def mtime_ns(self) -> int:
-        return (self.inode.di_mtime * 1_000_000_000) + self.inode.di_mtimensec
+        return self._timestamps_ns[1]
 
-    @cached_property
+    @property
     def ctime(self) -> datetime:
         return ts.from_unix_ns(self.ctime_ns)
 
-    @cached_property
+    @property
     def ctime_ns(self) -> int:
-        return (self.inode.di_ctime * 1_000_000_000) + self.inode.di_ctimensec
+        return self._timestamps_ns[2]
 
-    @cached_property
+    @property
     def btime(self) -> datetime | None:
         if btime_ns := self.btime_ns:
             return ts.from_unix_ns(btime_ns)
         return None
 
-    @cached_property
+    @property
     def btime_ns(self) -> int | None:
-        if hasattr(self.inode, "di_birthtime"):
-            return (self.inode.di_birthtime * 1_000_000_000) + self.inode.di_birthnsec
-        return None
+        return self._timestamps_ns[3]
 
     @cached_property
     def link(self) -> str:
@@ -274,23 +363,24 @@ class INode:
         if not self.is_dir():
             raise NotADirectoryError(f"{self!r} is not a directory")
 
-        buf = self.open()
+        # Read the directory data in one go and parse the entries from memory
+        buf = self.open().read()
         offset = 0
 
-        while offset < self.size - 8:
-            dirent = c_ffs.direct(buf)
-            if dirent.d_reclen == 0:
+        while offset < len(buf) - 8:
+            d_ino, d_reclen, d_type, d_namlen = direct_header.unpack_from(buf, offset)
+            if d_reclen == 0:
                 log.critical("Zero-length directory entry in %s (offset 0x%x)", self, offset)
                 return
 
-            dname = buf.read(dirent.d_namlen).decode(errors="surrogateescape")
-            dtype = dirent.d_type << 12
+            name_offset = offset + direct_header.size
+            dname = buf[name_offset : name_offset + d_namlen].decode(errors="surrogateescape")
+            dtype = d_type << 12
 
-            yield self.fs.inode(dirent.d_ino, dname, dtype, parent=self)
+            yield self.fs.inode(d_ino, dname, dtype, parent=self)
 
             # Can find slack entries if d_reclen > d_namlen (rounded to nearest 4 bytes)
-            offset += dirent.d_reclen
-            buf.seek(offset)
+            offset += d_reclen
 
     def dataruns(self) -> list[tuple[int, int]]:
         # So this is a bit confusing.
@@ -303,28 +393,27 @@ class INode:
         # there are 8 fragments in a file system block.
         # Because of this, we do a bit of run number manipulation to create an efficient run list.
         # To be safe, we also use the fragment size as block size for the RunlistStream.
-        if not self._runlist:
+        if self._runlist is None:
+            frag = self.fs._frag
+
+            # Runs are tracked in fragments, run_end being the fragment directly following the current run
             runs = []
             run_offset = None
-            run_size = 1
-            for block_num in self._iter_blocks():
-                if run_offset is None:
-                    run_offset = block_num
-                    continue
+            run_end = None
+            for blocks in self._iter_block_lists():
+                for block_num in blocks:
+                    if block_num == run_end:
+                        run_end += frag
+                        continue
 
-                if block_num == run_offset + (run_size * self.fs.sb.fs_frag):
-                    run_size += 1
-                else:
-                    run_size *= self.fs.sb.fs_frag
-                    if run_offset == 0:
-                        runs.append((None, run_size))
-                    else:
-                        runs.append((run_offset, run_size))
+                    if run_offset is not None:
+                        runs.append((run_offset or None, run_end - run_offset))
 
                     run_offset = block_num
-                    run_size = 1
+                    run_end = block_num + frag
 
-            runs.append((run_offset, run_size * self.fs.sb.fs_frag))
+            if run_offset is not None:
+                runs.append((run_offset or None, run_end - run_offset))
 
             self._runlist = runs
 
@@ -335,8 +424,8 @@ class INode:
             # This is a bit hacky since we prefer to parse di_db and di_ib as arrays, rather than bytes
             # However, short symlinks store the link here
             buf = io.BytesIO()
-            self.fs._addr_type[c_ffs.UFS_NDADDR].write(buf, self.inode.di_db)
-            self.fs._addr_type[c_ffs.UFS_NIADDR].write(buf, self.inode.di_ib)
+            self.fs._addr_array_type(c_ffs.UFS_NDADDR).write(buf, self.inode.di_db)
+            self.fs._addr_array_type(c_ffs.UFS_NIADDR).write(buf, self.inode.di_ib)
             buf.seek(0)
             buf.truncate(self.size)
             # Need to add a size attribute to maintain compatibility with dissect streams
@@ -345,55 +434,48 @@ class INode:
 
         return RunlistStream(self.fs.fh, self.dataruns(), self.size, self.fs.fragment_size)
 
-    def _iter_blocks(self) -> Iterator[int]:
+    def _iter_block_lists(self) -> Iterator[list[int]]:
+        # Yields the block addresses per direct block list or single indirect block,
+        # so consumers can process them in a tight loop rather than one generator step per block
         num_blocks = (self.size + (self.fs.block_size - 1)) // self.fs.block_size
         num_direct_blocks = min(num_blocks, c_ffs.UFS_NDADDR)
 
-        blocks = self.inode.di_db[:num_direct_blocks]
+        yield self.inode.di_db[:num_direct_blocks]
         num_blocks -= num_direct_blocks
 
-        yield from blocks
-
-        if num_blocks > 0:
-            for level1 in range(c_ffs.UFS_NIADDR):
-                indirect_block = self.inode.di_ib[level1]
-                for block, level2 in self._walk_indirect(indirect_block, level1 + 1, num_blocks):
-                    if level2 != 0:
-                        continue
-
-                    yield block
-                    num_blocks -= 1
+        # Walk the indirect block trees depth first using an explicit stack, instead of recursing per address
+        addresses_per_block = self.fs._nindir
+        stack = [(self.inode.di_ib[level - 1], level) for level in range(c_ffs.UFS_NIADDR, 0, -1)]
+        while num_blocks > 0 and stack:
+            block, level = stack.pop()
 
-                    if num_blocks == 0:
-                        return
-
-    def _walk_indirect(self, block: int, level: int, num_blocks: int) -> Iterator[tuple[int, int]]:
-        yield block, level
-
-        if level > 0:
-            addresses_per_block = self.fs.sb.fs_nindir
-            max_level_blocks = addresses_per_block**level
-            blocks_per_nest = max_level_blocks // addresses_per_block
+            # Only read as many addresses as are needed for the remaining blocks
+            blocks_per_nest = addresses_per_block ** (level - 1)
             read_blocks = (num_blocks + blocks_per_nest - 1) // blocks_per_nest
             read_blocks = min(read_blocks, addresses_per_block)
 
             self.fs.fh.seek(fsbtodb(self.fs, block) * DEV_BSIZE)
-            for addr in self.fs._addr_type[read_blocks](self.fs.fh):
-                yield from self._walk_indirect(addr, level - 1, num_blocks)
+            addresses = self.fs._addr_array_type(read_blocks)(self.fs.fh)
+
+            if level == 1:
+                yield addresses
+                num_blocks -= read_blocks
+            else:
+                stack.extend((addr, level - 1) for addr in reversed(addresses))
 
 
 # Some useful C macros used by UFS/FFS converted to Python functions
 # The names are kept to ease debugging/readability when comparing to the original source.
 def fsbtodb(fs: FFS, b: int) -> int:
-    return b << fs.sb.fs_fsbtodb
+    return b << fs._fsbtodb
 
 
 def dbtofsb(fs: FFS, b: int) -> int:
-    return b >> fs.sb.fs_fsbtodb
+    return b >> fs._fsbtodb
 
 
 def cgbase(fs: FFS, c: int) -> int:
-    return fs.sb.fs_fpg * c
+    return fs._fpg * c
 
 
 def cgdata(fs: FFS, c: int) -> int:
@@ -409,7 +491,7 @@ def cgdmin(fs: FFS, c: int) -> int:
 
 
 def cgimin(fs: FFS, c: int) -> int:
-    return cgstart(fs, c) + fs.sb.fs_iblkno
+    return cgstart(fs, c) + fs._iblkno
 
 
 def cgsblock(fs: FFS, c: int) -> int:
@@ -421,26 +503,26 @@ def cgtod(fs: FFS, c: int) -> int:
 
 
 def cgstart(fs: FFS, c: int) -> int:
-    if fs.sb.fs_magic == c_ffs.FS_UFS2_MAGIC:
+    if fs.version == 2:
         return cgbase(fs, c)
 
-    return cgbase(fs, c) + fs.sb.fs_old_cgoffset * (c & ~fs.sb.fs_old_cgmask)
+    return cgbase(fs, c) + fs._old_cgoffset * (c & ~fs._old_cgmask)
 
 
 def ino_to_cg(fs: FFS, x: int) -> int:
     # inode number to cylinder group number.
-    return x // fs.sb.fs_ipg
+    return x // fs._ipg
 
 
 def ino_to_fsba(fs: FFS, x: int) -> int:
     # inode number to filesystem block address.
-    return cgimin(fs, ino_to_cg(fs, x)) + blkstofrags(fs, (x % fs.sb.fs_ipg) // fs.sb.fs_inopb)
+    return cgimin(fs, ino_to_cg(fs, x)) + blkstofrags(fs, (x % fs._ipg) // fs._inopb)
 
 
 def ino_to_fsbo(fs: FFS, x: int) -> int:
     # inode number to filesystem block offset.
-    return x % fs.sb.fs_inopb
+    return x % fs._inopb
 
 
 def blkstofrags(fs: FFS, blks: int) -> int:
-    return blks << fs.sb.fs_fragshift
+    return blks << fs._fragshift
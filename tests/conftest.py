@@ -1,24 +1,35 @@
 from __future__ import annotations
 
 import gzip
+from io import BytesIO
 from pathlib import Path
-from typing import TYPE_CHECKING, BinaryIO
+from typing import BinaryIO
 
 import pytest
 
-if TYPE_CHECKING:
-    from collections.abc import Iterator
+from dissect.ffs import FFS
 
 
 def absolute_path(filename: str) -> Path:
     return Path(__file__).parent / filename
 
 
-def gzip_file(filename: str) -> Iterator[BinaryIO]:
-    with gzip.GzipFile(absolute_path(filename), "rb") as fh:
-        yield fh
+def gzip_file(filename: str) -> BinaryIO:
+    # Decompress the entire image in a single call, so reads and seeks are served from memory
+    return BytesIO(gzip.decompress(absolute_path(filename).read_bytes()))
 
 
-@pytest.fixture
-def ffs_bin() -> Iterator[BinaryIO]:
-    yield from gzip_file("data/ffs.bin.gz")
+@pytest.fixture(scope="session")
+def ffs_bin() -> BinaryIO:
+    return gzip_file("data/ffs.bin.gz")
+
+
+@pytest.fixture(scope="session")
+def ffs(ffs_bin: BinaryIO) -> FFS:
+    return FFS(ffs_bin)
+
+
+@pytest.fixture(scope="session")
+def ffs_symlink_bin(request: pytest.FixtureRequest) -> BinaryIO:
+    # Decompress each parametrized image only once per session
+    return gzip_file(request.param)
@@ -1,70 +1,216 @@
 from __future__ import annotations
 
 import datetime
-import gzip
+import gc
 import stat
+import struct
 from io import BytesIO
+from types import SimpleNamespace
 from typing import TYPE_CHECKING, BinaryIO
 from unittest.mock import call, patch
 
 import pytest
 
-from dissect.ffs.ffs import FFS, INode
+from dissect.ffs.c_ffs import c_ffs
+from dissect.ffs.exceptions import Error
+from dissect.ffs.ffs import DEV_BSIZE, FFS, INode
 
 if TYPE_CHECKING:
-    from logging import Logger
+    from collections.abc import Iterator
+    from unittest.mock import Mock
 
+ROOT_ATIME = datetime.datetime(2022, 4, 22, 14, 15, 14, tzinfo=datetime.timezone.utc)
 
-def test_ffs(ffs_bin: BinaryIO) -> None:
-    ffs = FFS(ffs_bin)
+# Directory data consisting of a single zero-length entry
+ZERO_DIRECTORY = bytes(16)
 
+
+def test_ffs(ffs: FFS) -> None:
     assert ffs.version == 2
     assert ffs.block_size == 32 * 1024
 
     root = ffs.root
     assert root.type == stat.S_IFDIR
     assert root.is_dir()
-    assert root.atime == datetime.datetime(2022, 4, 22, 14, 15, 14, tzinfo=datetime.timezone.utc)
+    assert root.atime == ROOT_ATIME
     assert root.atime_ns == 1650636914000000000
-    assert list(root.listdir().keys()) == [".", "..", ".snap", "test_file", "test_dir"]
+    entries = root.listdir()
+    assert list(entries.keys()) == [".", "..", ".snap", "test_file", "test_dir"]
 
-    test_file = ffs.get("test_file")
+    test_file = entries["test_file"]
     assert test_file.nblocks == 8
     assert test_file.open().read() == b"test contents\n"
 
     test_dir = ffs.get("test_dir")
     assert test_dir.nblocks == 8
 
+    assert [inode.inum for inode in ffs.iter_inodes()] == [2, 3, 4, 256, 257]
+
 
 @pytest.mark.parametrize(
-    "image_file",
+    "ffs_symlink_bin",
     [
-        ("tests/data/ffs_symlink_test1.bin.gz"),
-        ("tests/data/ffs_symlink_test2.bin.gz"),
-        ("tests/data/ffs_symlink_test3.bin.gz"),
+        ("data/ffs_symlink_test1.bin.gz"),
+        ("data/ffs_symlink_test2.bin.gz"),
+        ("data/ffs_symlink_test3.bin.gz"),
     ],
+    indirect=True,
 )
-def test_symlinks(image_file: str) -> None:
+def test_symlinks(ffs_symlink_bin: BinaryIO) -> None:
     path = "/path/to/dir/with/file.ext"
     expect = b"resolved!\n"
 
     def resolve(node: INode) -> INode:
-        while node.type == stat.S_IFLNK:
+        while node.is_symlink():
             node = node.link_inode
         return node
 
-    with gzip.open(image_file, "rb") as disk:
-        node = FFS(disk).get(path)
-        assert node.nblocks == 0
-        assert resolve(node).open().read() == expect
-
-
-@patch("dissect.ffs.ffs.INode.open", return_value=BytesIO(b"\x00" * 16))
-@patch("dissect.ffs.ffs.log", create=True, return_value=None)
-@patch("dissect.ffs.ffs.FFS")
-def test_infinite_loop_protection(FFS: FFS, log: Logger, *args) -> None:
-    inode = INode(FFS, 1, filetype=stat.S_IFDIR)
-    inode.size = 16
+    node = FFS(ffs_symlink_bin).get(path)
+    assert node.nblocks == 0
+    assert resolve(node).open().read() == expect
+
+
+@pytest.mark.parametrize("ffs_symlink_bin", ["data/ffs_symlink_test1.bin.gz"], indirect=True)
+def test_symlink_loop(ffs_symlink_bin: BinaryIO) -> None:
+    ffs = FFS(ffs_symlink_bin)
+
+    node = ffs.get("/other/path/source/to")
+    assert node.is_symlink()
+
+    # Make the symlink point to itself
+    node.link_inode = node
+    with pytest.raises(Error, match="Symlink loop"):
+        ffs.get("/other/path/source/to/my")
+
+
+def make_indirect_inode(blocks: list[int]) -> INode:
+    # Build a UFS2 file with 4 addresses per indirect block, which needs all three indirect levels for 37 blocks
+    fh = BytesIO()
+    fs = SimpleNamespace(
+        fh=fh,
+        block_size=4096,
+        _frag=8,
+        _nindir=4,
+        _fsbtodb=0,
+        _addr_array_type=lambda count: c_ffs.ufs2_daddr_t[count],
+    )
+
+    indirect_blocks = iter(range(1, 100))
+
+    def write_indirect(addresses: list[int]) -> int:
+        block = next(indirect_blocks)
+        fh.seek(block * DEV_BSIZE)
+        fh.write(struct.pack(f"<{len(addresses)}q", *addresses))
+        return block
+
+    di_ib = [0, 0, 0]
+    if len(blocks) > 12:
+        di_ib[0] = write_indirect(blocks[12:16])
+    if len(blocks) > 16:
+        di_ib[1] = write_indirect([write_indirect(blocks[i : i + 4]) for i in range(16, min(len(blocks), 32), 4)])
+    if len(blocks) > 32:
+        # The last single indirect block is only partly filled
+        di_ib[2] = write_indirect(
+            [write_indirect([write_indirect(blocks[i : i + 4]) for i in range(32, len(blocks), 4)])]
+        )
+
+    inode = INode(fs, 1, filetype=stat.S_IFREG)
+    inode.inode = SimpleNamespace(
+        di_size=max(0, len(blocks) * fs.block_size - 100),
+        di_db=blocks[:12] + [0] * (12 - len(blocks[:12])),
+        di_ib=di_ib,
+    )
+    return inode
+
+
+def test_dataruns_indirect() -> None:
+    # Contiguous data blocks, so any misordered or missed address breaks up the run
+    inode = make_indirect_inode([1000 + (i * 8) for i in range(37)])
+    assert inode.dataruns() == [(1000, 37 * 8)]
+
+    blocks = [1000 + (i * 8) for i in range(37)]
+    blocks[5] = 5000
+    blocks[14] = 6000
+    blocks[20] = 7000
+    blocks[35] = 8000
+    inode = make_indirect_inode(blocks)
+    assert inode.dataruns() == [
+        (1000, 5 * 8),
+        (5000, 8),
+        (1048, 8 * 8),
+        (6000, 8),
+        (1120, 5 * 8),
+        (7000, 8),
+        (1168, 14 * 8),
+        (8000, 8),
+        (1288, 8),
+    ]
+
+
+def test_dataruns_sparse() -> None:
+    # A trailing sparse block is a sparse run, not a run at block 0
+    blocks = [1000 + (i * 8) for i in range(37)]
+    blocks[36] = 0
+    inode = make_indirect_inode(blocks)
+    assert inode.dataruns() == [(1000, 36 * 8), (None, 8)]
+
+    # A file without any blocks has no runs, and the empty run list is cached
+    inode = make_indirect_inode([])
+    assert inode.dataruns() == []
+    assert inode.dataruns() is inode.dataruns()
+
+
+@pytest.mark.parametrize("ffs_symlink_bin", ["data/ffs_symlink_test1.bin.gz"], indirect=True)
+def test_symlink_loop_nested(ffs_symlink_bin: BinaryIO) -> None:
+    # Point /other/path/source/to (an inline symlink to "../target/to") to a path through itself
+    buf = ffs_symlink_bin.getvalue()
+    assert buf.count(b"../target/to") == 1
+    ffs = FFS(BytesIO(buf.replace(b"../target/to", b"./././to/x/y")))
+
+    assert ffs.get("/other/path/source/to").link == "./././to/x/y"
+    with pytest.raises(Error, match="Symlink loop"):
+        ffs.get("/other/path/source/to/my")
+
+    # A failed lookup does not leave symlinks marked as being resolved
+    assert not ffs._resolving
+
+
+@pytest.mark.parametrize("ffs_symlink_bin", ["data/ffs_symlink_test1.bin.gz"], indirect=True)
+def test_inode_cache(ffs_symlink_bin: BinaryIO) -> None:
+    ffs = FFS(ffs_symlink_bin)
+
+    # The same lookup returns the same live INode
+    node = ffs.inode(3, "file.ext", stat.S_IFREG, ffs.root)
+    assert ffs.inode(3, "file.ext", stat.S_IFREG, ffs.root) is node
+    assert ffs.inode(3) is not node
+
+    # INodes are dropped from the cache once they are no longer referenced
+    del node
+    gc.collect()
+    assert list(ffs._inode_cache.values()) == [ffs.root]
+
+    # Resolving a path does not keep the traversed directories and their entries alive
+    node = ffs.get("/path/to/dir/with/file.ext")
+    assert len(ffs._inode_cache) > 1
+    del node
+    gc.collect()
+    assert list(ffs._inode_cache.values()) == [ffs.root]
+
+
+@pytest.fixture
+def zero_length_dir() -> Iterator[tuple[INode, Mock]]:
+    with (
+        patch("dissect.ffs.ffs.INode.open", return_value=BytesIO(ZERO_DIRECTORY)),
+        patch("dissect.ffs.ffs.log", create=True, return_value=None) as log,
+        patch("dissect.ffs.ffs.FFS") as fs,
+    ):
+        inode = INode(fs, 1, filetype=stat.S_IFDIR)
+        inode.size = 16
+        yield inode, log
+
+
+def test_infinite_loop_protection(zero_length_dir: tuple[INode, Mock]) -> None:
+    inode, log = zero_length_dir
     for _ in inode.iterdir():
         pass
     assert call.critical("Zero-length directory entry in %s (offset 0x%x)", inode, 0) in log.mock_calls